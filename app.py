@@ -1,14 +1,46 @@
+import functools
+import hashlib
+import io
 import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 import traceback
-from flask import Flask, jsonify, render_template
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, jsonify, render_template, request
+from flask.json.provider import JSONProvider
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import AuthorizedSession
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import grpc
 import gspread
+import httplib2
+import orjson
+from PIL import Image, ImageOps
 from yandexcloud import SDK
-import requests
-import time
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectTimeout
+from urllib3.util.retry import Retry
+from tenacity import Retrying, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 REQUIRED_ENV_VARS = ["YANDEX_API_KEY", "SPREADSHEET_ID", "TO_ANALYZE_FOLDER_ID", "ANALYZED_FOLDER_ID"]
 
@@ -23,7 +55,89 @@ HEADERS = [
     "File URL",
 ]
 
-BATCH_SIZE = 5
+FIELDS = [
+    "catalog_number",
+    "description",
+    "machine_type",
+    "manufacturer",
+    "analogs",
+    "detail_description",
+    "machine_model",
+]
+
+UNKNOWN_FIELDS = dict.fromkeys(FIELDS, "UNKNOWN")
+
+# Каждое поле ищется своим шаблоном: совпадение одного не должно поглощать текст другого
+FIELD_PATTERNS = {
+    "catalog_number": re.compile(r"Catalog\s*(\S+)"),
+    "description": re.compile(r"Description[ \t]*([^\n]+)"),
+}
+
+# Статическая часть запроса к Vision, меняется только content
+TEXT_DETECTION_FEATURES = [{"type": "TEXT_DETECTION"}]
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+VISION_WORKERS = int(os.getenv("ANALYZE_CONCURRENCY", "4"))
+if DOWNLOAD_WORKERS < 1 or VISION_WORKERS < 1:
+    raise ValueError(
+        f"DOWNLOAD_CONCURRENCY и ANALYZE_CONCURRENCY должны быть не меньше 1, задано: {DOWNLOAD_WORKERS}, {VISION_WORKERS}"
+    )
+# Сколько изображений отправлять в одном Analyze (лимит API — 8)
+VISION_BATCH_SIZE = 5
+# Сколько ждать добора пакета, прежде чем отправить неполный, в секундах
+VISION_BATCH_WAIT = 0.2
+SHEETS_CHUNK_SIZE = 50
+DRIVE_BATCH_LIMIT = 100
+DRIVE_PAGE_SIZE = 1000
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media&supportsAllDrives=true"
+DRIVE_DOWNLOAD_URL = "https://drive.google.com/uc?export=download&id={}"
+
+# (connect, read) для скачивания и дедлайн gRPC-вызова Vision, в секундах
+DOWNLOAD_TIMEOUT = (3.05, 30)
+VISION_TIMEOUT = 30
+
+# Всё, что открывает Pillow: preprocess_image перекодирует это в JPEG.
+# Остальное не скачивается и не распознаётся, а пишется в таблицу с пометкой skipped
+Image.init()
+SUPPORTED_MIME_TYPES = {mime for fmt, mime in Image.MIME.items() if fmt in Image.OPEN}
+# Лимит на то, что уходит в Vision; уменьшенные до IMAGE_MAX_SIDE файлы в него укладываются
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# Перед отправкой в Vision фото уменьшается до IMAGE_MAX_SIDE по длинной стороне
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+JPEG_QUALITY = 85
+# Форматы, которые Vision принимает как есть
+PASSTHROUGH_FORMATS = {"JPEG", "PNG"}
+EXIF_ORIENTATION = 0x0112
+
+# Распознанный текст по md5 содержимого из Drive и параметрам предобработки:
+# повторно загруженные фото не уходят в Vision, а смена IMAGE_MAX_SIDE распознаёт их заново
+VISION_CACHE_PATH = os.getenv("VISION_CACHE_PATH", "vision_cache.db")
+vision_cache_lock = threading.Lock()
+
+# Ответы Drive, после которых перемещение стоит повторить
+RETRYABLE_HTTP_STATUSES = {429, 500, 502, 503, 504}
+
+# Запросов к Vision в секунду, на весь процесс
+YANDEX_RPS = float(os.getenv("YANDEX_RPS", "8"))
+if YANDEX_RPS <= 0:
+    raise ValueError(f"YANDEX_RPS должен быть больше нуля, задано: {YANDEX_RPS}")
+
+# Временные ошибки Vision: превышение квоты, недоступность, дедлайн
+RETRYABLE_GRPC_CODES = {
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+}
+
+_STOP = object()
+
+# Один воркер: две параллельные задачи читали бы одну и ту же папку TO_ANALYZE
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analyze-job")
+jobs = {}
+jobs_lock = threading.Lock()
+# Сколько последних задач хранить; старые завершённые вытесняются
+MAX_JOBS = 20
 
 
 def check_requirements():
@@ -39,18 +153,16 @@ def check_requirements():
         print(f"[INFO] ✅ Найден файл сервисного аккаунта: {credentials_path}")
 
 
-def get_google_services():
-    credentials_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "/etc/secrets/credentials.json")
-    if not os.path.exists(credentials_path):
-        raise FileNotFoundError(f"Не найден файл credentials.json по пути: {credentials_path}")
+def headers_sentinel_path(spreadsheet_id):
+    hdr_hash = hashlib.md5(("|".join(HEADERS) + spreadsheet_id).encode()).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f".headers_ok_{hdr_hash}")
 
-    creds = Credentials.from_service_account_file(
-        credentials_path,
-        scopes=["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/spreadsheets"],
-    )
-    drive_service = build("drive", "v3", credentials=creds)
-    sheet = gspread.authorize(creds).open_by_key(os.getenv("SPREADSHEET_ID")).sheet1
 
+def ensure_headers(sheet, spreadsheet_id):
+    # Метка сбрасывается сама при смене HEADERS или таблицы
+    sentinel = headers_sentinel_path(spreadsheet_id)
+    if os.path.exists(sentinel):
+        return
     try:
         existing = sheet.row_values(1)
         if not existing:
@@ -58,12 +170,49 @@ def get_google_services():
         elif existing != HEADERS:
             sheet.delete_rows(1)
             sheet.insert_row(HEADERS, 1)
+        open(sentinel, "w").close()
     except Exception as e:
         print(f"[ERROR] Ошибка проверки заголовков: {e}")
 
+
+@functools.lru_cache(maxsize=1)
+def get_google_credentials():
+    credentials_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "/etc/secrets/credentials.json")
+    if not os.path.exists(credentials_path):
+        raise FileNotFoundError(f"Не найден файл credentials.json по пути: {credentials_path}")
+
+    return Credentials.from_service_account_file(
+        credentials_path,
+        scopes=["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/spreadsheets"],
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_google_services():
+    creds = get_google_credentials()
+    spreadsheet_id = os.getenv("SPREADSHEET_ID")
+    drive_service = build("drive", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
+    sheet = gspread.authorize(creds).open_by_key(spreadsheet_id).sheet1
+    ensure_headers(sheet, spreadsheet_id)
     return drive_service, sheet
 
 
+# Скачивание через Drive API с авторизацией: webContentLink требует публичного доступа
+# и для больших файлов отдаёт HTML-страницу проверки на вирусы вместо картинки
+@functools.lru_cache(maxsize=1)
+def get_drive_session():
+    session = AuthorizedSession(get_google_credentials())
+    # По соединению на поток скачивания, чтобы TLS не поднимался заново;
+    # 429 и 5xx от Drive повторяются с backoff и учётом Retry-After
+    adapter = HTTPAdapter(
+        pool_maxsize=DOWNLOAD_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=1)
 def get_yandex_client():
     token = os.getenv("YANDEX_API_KEY")
     if not token:
@@ -73,6 +222,23 @@ def get_yandex_client():
     return sdk.client(service_name="ai.vision.v1.ImageAnalyzer")
 
 
+def reset_google_clients():
+    # Ключ сервисного аккаунта отозван или заменён: следующая задача перечитает credentials.json
+    get_google_credentials.cache_clear()
+    get_google_services.cache_clear()
+    get_drive_session.cache_clear()
+
+
+def init_services():
+    try:
+        get_google_services()
+        get_drive_session()
+        get_yandex_client()
+        print("[INFO] ✅ Клиенты Google и Yandex инициализированы")
+    except Exception as e:
+        print(f"[ERROR] Не удалось инициализировать клиенты: {e}")
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -83,97 +249,484 @@ def ping():
     return jsonify({"status": "ok", "message": "pong"})
 
 
-@app.route("/analyze", methods=["POST"])
-def analyze():
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # Меньше одного токена бакет не накопит никогда, и acquire() не вернётся
+        self.capacity = max(1.0, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+vision_rate_limiter = TokenBucket(YANDEX_RPS)
+
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        jobs[job_id].update(fields)
+
+
+def add_processed_many(job_id, items):
+    with jobs_lock:
+        jobs[job_id]["processed"].extend(items)
+
+
+def start_workers(count, target, *args):
+    threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def stop_workers(threads, q):
+    for _ in threads:
+        q.put(_STOP)
+    for t in threads:
+        t.join()
+
+
+def take_chunk(q, limit, wait=0):
+    chunk = [q.get()]
+    deadline = time.monotonic() + wait
+    while chunk[-1] is not _STOP and len(chunk) < limit:
+        try:
+            chunk.append(q.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    finished = chunk[-1] is _STOP
+    if finished:
+        chunk.pop()
+    return chunk, finished
+
+
+def is_retryable_vision_error(exc):
+    return isinstance(exc, grpc.RpcError) and exc.code() in RETRYABLE_GRPC_CODES
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(is_retryable_vision_error),
+    reraise=True,
+)
+def call_vision(vision_client, folder_id, contents):
+    vision_rate_limiter.acquire()
+    return vision_client.Analyze(
+        folder_id=folder_id,
+        analyze_specs=[{"content": content, "features": TEXT_DETECTION_FEATURES} for content in contents],
+        timeout=VISION_TIMEOUT,
+    )
+
+
+def result_text(result):
+    # Строки через \n: Description берётся до конца своей строки
+    return "\n".join(
+        " ".join(el.text for el in line.elements)
+        for text_block in result.text_detection.pages[0].blocks
+        for line in text_block.lines
+    )
+
+
+def recognize_batch(vision_client, folder_id, items):
+    if not items:
+        return {}
+    names = ", ".join(f["name"] for f, _, _ in items)
+    print(f"[INFO] Анализ {names} ...")
+
+    try:
+        response = call_vision(vision_client, folder_id, [content for _, _, content in items])
+        if len(response.results) != len(items):
+            raise RuntimeError(f"Vision вернул {len(response.results)} результатов на {len(items)} изображений")
+    except Exception as e:
+        # Квота или недоступность уже пережили ретраи call_vision: поштучные запросы упрутся в то же самое
+        if len(items) == 1 or is_retryable_vision_error(e):
+            print(f"[ERROR] Ошибка анализа {names}: {e}")
+            traceback.print_exc()
+            return {}
+        print(f"[WARNING] Пакетный запрос не удался ({e}), анализируем по одному")
+        texts = {}
+        for item in items:
+            texts.update(recognize_batch(vision_client, folder_id, [item]))
+        return texts
+
+    texts = {}
+    for (f, _, _), result in zip(items, response.results):
+        if result.error.code:
+            print(f"[ERROR] Ошибка анализа {f['name']}: {result.error.message}")
+            continue
+        try:
+            texts[f["id"]] = result_text(result)
+            cache_put(f.get("md5Checksum"), texts[f["id"]])
+        except Exception as e:
+            print(f"[ERROR] Ошибка разбора ответа для {f['name']}: {e}")
+            traceback.print_exc()
+    return texts
+
+
+def parse_fields(full_text):
+    fields = UNKNOWN_FIELDS.copy()
+    for key, pattern in FIELD_PATTERNS.items():
+        m = pattern.search(full_text)
+        if m:
+            fields[key] = m.group(1)
+    return fields
+
+
+@functools.lru_cache(maxsize=1)
+def get_vision_cache():
+    conn = sqlite3.connect(VISION_CACHE_PATH, check_same_thread=False)
+    # cache_put коммитит на каждое изображение; в WAL с synchronous=NORMAL коммит не делает fsync
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS vision_text (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+    conn.commit()
+    return conn
+
+
+def cache_key(md5):
+    return f"{md5}:{IMAGE_MAX_SIDE}:{JPEG_QUALITY}"
+
+
+def cache_get(md5):
+    if not md5:
+        return None
+    with vision_cache_lock:
+        row = get_vision_cache().execute("SELECT text FROM vision_text WHERE key = ?", (cache_key(md5),)).fetchone()
+    return row[0] if row else None
+
+
+def cache_put(md5, text):
+    # Пустой текст не кэшируется: изображение без распознанного текста попробуем снова
+    if not md5 or not text:
+        return
+    with vision_cache_lock:
+        conn = get_vision_cache()
+        conn.execute("INSERT OR REPLACE INTO vision_text (key, text) VALUES (?, ?)", (cache_key(md5), text))
+        conn.commit()
+
+
+def download_image(session, file_id):
+    response = session.get(DRIVE_MEDIA_URL.format(file_id), timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def preprocess_image(raw):
+    # Image.open читает только заголовок; уже подходящий файл не декодируется и не пережимается
+    img = Image.open(io.BytesIO(raw))
+    if (
+        img.format in PASSTHROUGH_FORMATS
+        and max(img.size) <= IMAGE_MAX_SIDE
+        # Для PNG getexif() декодирует изображение целиком, а EXIF-поворот в PNG почти не встречается
+        and (img.format != "JPEG" or img.getexif().get(EXIF_ORIENTATION, 1) == 1)
+    ):
+        return raw
+
+    # Для JPEG libjpeg сразу декодирует в 1/2, 1/4 или 1/8 масштаба, не ниже IMAGE_MAX_SIDE
+    img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def skip_reason(f):
+    if f.get("mimeType") not in SUPPORTED_MIME_TYPES:
+        return "mime"
+    return None
+
+
+def download_worker(session, files_q, downloaded_q, analyzed_q):
+    while True:
+        f = files_q.get()
+        if f is _STOP:
+            return
+        file_url = f.get("webContentLink") or DRIVE_DOWNLOAD_URL.format(f["id"])
+
+        reason = skip_reason(f)
+        if reason:
+            print(f"[WARNING] {f['name']} пропущен: {reason} ({f.get('mimeType')}, {f.get('size')} байт)")
+            fields = UNKNOWN_FIELDS.copy()
+            fields["description"] = f"skipped: {reason}"
+            analyzed_q.put((f, file_url, fields))
+            continue
+
+        try:
+            cached_text = cache_get(f.get("md5Checksum"))
+        except Exception:
+            traceback.print_exc()
+            cached_text = None
+        if cached_text is not None:
+            print(f"[INFO] {f['name']}: результат из кэша")
+            analyzed_q.put((f, file_url, parse_fields(cached_text)))
+            continue
+
+        content = None
+        try:
+            content = download_image(session, f["id"])
+        except Exception as e:
+            print(f"[ERROR] Не удалось скачать {f['name']}: {e}")
+            traceback.print_exc()
+
+        if content is not None:
+            try:
+                content = preprocess_image(content)
+            except Exception as e:
+                print(f"[WARNING] Не удалось уменьшить {f['name']}, отправляем оригинал: {e}")
+        if content is not None and len(content) > MAX_IMAGE_BYTES:
+            print(f"[ERROR] {f['name']}: {len(content)} байт, больше лимита Vision")
+            content = None
+        downloaded_q.put((f, file_url, content))
+
+
+def vision_worker(vision_client, folder_id, downloaded_q, analyzed_q):
+    finished = False
+    while not finished:
+        batch, finished = take_chunk(downloaded_q, VISION_BATCH_SIZE, VISION_BATCH_WAIT)
+        texts = recognize_batch(vision_client, folder_id, [item for item in batch if item[2] is not None])
+        for f, file_url, _ in batch:
+            text = texts.get(f["id"])
+            fields = parse_fields(text) if text is not None else UNKNOWN_FIELDS.copy()
+            analyzed_q.put((f, file_url, fields))
+
+
+def list_files(drive, folder_id):
+    # Своё HTTP-соединение: одновременно с листингом поток записи перемещает файлы
+    # через тот же drive, а httplib2 не потокобезопасен
+    http = AuthorizedHttp(get_google_credentials(), http=httplib2.Http())
+    page_token = None
+    while True:
+        results = drive.files().list(
+            q=f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false",
+            pageSize=DRIVE_PAGE_SIZE,
+            pageToken=page_token,
+            orderBy="createdTime",
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            fields="nextPageToken, files(id, name, mimeType, size, webContentLink, parents, md5Checksum)",
+        ).execute(http=http)
+        yield from results.get("files", [])
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
+
+
+class PendingMoves(Exception):
+    pass
+
+
+def is_retryable_drive_error(exc):
+    if isinstance(exc, HttpError):
+        return exc.resp.status in RETRYABLE_HTTP_STATUSES
+    return isinstance(exc, (PendingMoves, httplib2.HttpLib2Error, OSError))
+
+
+def move_batch(drive, files, analyzed_folder):
+    retry_later = []
+
+    def on_moved(request_id, response, exception):
+        if exception is None:
+            return
+        f = files[int(request_id)]
+        if is_retryable_drive_error(exception):
+            retry_later.append(f)
+        else:
+            print(f"[ERROR] Не удалось переместить {f['name']}: {exception}")
+
+    batch = drive.new_batch_http_request(callback=on_moved)
+    for i, f in enumerate(files):
+        batch.add(
+            drive.files().update(
+                fileId=f["id"],
+                addParents=analyzed_folder,
+                removeParents=",".join(f.get("parents", [])),
+                supportsAllDrives=True,
+                fields="id, parents"
+            ),
+            request_id=str(i),
+        )
+    batch.execute()
+    return retry_later
+
+
+def move_files(drive, files, analyzed_folder):
+    for i in range(0, len(files), DRIVE_BATCH_LIMIT):
+        # Повторяются только временные ошибки и только для не перемещённых файлов
+        pending = files[i:i + DRIVE_BATCH_LIMIT]
+        try:
+            for attempt in Retrying(
+                wait=wait_random_exponential(min=1, max=30),
+                stop=stop_after_attempt(4),
+                retry=retry_if_exception(is_retryable_drive_error),
+                reraise=True,
+            ):
+                with attempt:
+                    pending = move_batch(drive, pending, analyzed_folder)
+                    if pending:
+                        raise PendingMoves()
+        except Exception as e:
+            names = ", ".join(f["name"] for f in pending)
+            print(f"[ERROR] Не удалось переместить {names}: {e!r}")
+            traceback.print_exc()
+
+
+def is_unapplied_sheets_error(exc):
+    # 4xx — запрос отклонён целиком, ConnectTimeout — он не дошёл до сервера;
+    # после таймаута ответа или 5xx строки могли уже записаться
+    if isinstance(exc, gspread.exceptions.APIError):
+        return 400 <= exc.response.status_code < 500
+    return isinstance(exc, ConnectTimeout)
+
+
+def write_rows(sheet, rows):
+    try:
+        sheet.append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+        return
+    except Exception as e:
+        if not is_unapplied_sheets_error(e):
+            raise
+        print(f"[WARNING] Не удалось записать {len(rows)} строк одним запросом, пишем по одной")
+        traceback.print_exc()
+
+    for row in rows:
+        try:
+            sheet.append_row(row, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+        except Exception:
+            print(f"[ERROR] Не удалось записать строку для {row[-1]}")
+            traceback.print_exc()
+
+
+def sheets_worker(job_id, drive, sheet, analyzed_folder, analyzed_q):
+    finished = False
+    while not finished:
+        chunk, finished = take_chunk(analyzed_q, SHEETS_CHUNK_SIZE)
+        if not chunk:
+            continue
+
+        move_files(drive, [f for f, _, _ in chunk], analyzed_folder)
+
+        rows = [[fields[k] for k in FIELDS] + [file_url] for _, file_url, fields in chunk]
+        try:
+            write_rows(sheet, rows)
+        except Exception as e:
+            # Повтор мог бы задвоить строки, поэтому только сообщаем
+            print(f"[ERROR] Таблица не подтвердила запись {len(rows)} строк: {e!r}")
+            traceback.print_exc()
+            update_job(job_id, message="Часть строк могла не записаться в таблицу, проверьте её")
+
+        add_processed_many(job_id, [
+            {
+                "file": f["name"],
+                "catalog_number": fields["catalog_number"],
+                "description": fields["description"]
+            }
+            for f, _, fields in chunk
+        ])
+
+
+def run_analysis(job_id):
+    update_job(job_id, status="running")
     try:
         drive, sheet = get_google_services()
+        session = get_drive_session()
         vision_client = get_yandex_client()
     except Exception as e:
         traceback.print_exc()
-        return jsonify({"status": "error", "message": str(e)}), 500
+        if isinstance(e, RefreshError):
+            reset_google_clients()
+        update_job(job_id, status="error", message=str(e))
+        return
 
     TO_ANALYZE = os.getenv("TO_ANALYZE_FOLDER_ID")
     ANALYZED = os.getenv("ANALYZED_FOLDER_ID")
-    processed = []
-
-    try:
-        results = drive.files().list(
-            q=f"'{TO_ANALYZE}' in parents and mimeType contains 'image/'",
-            fields="files(id, name, webViewLink, webContentLink)",
-        ).execute()
-        files = results.get("files", [])
-    except Exception:
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": "Google Drive недоступен"}), 500
-
-    for i in range(0, len(files), BATCH_SIZE):
-        batch = files[i:i + BATCH_SIZE]
-        for f in batch:
-            file_id, file_name = f["id"], f["name"]
-            file_url = f.get("webContentLink") or f"https://drive.google.com/uc?export=download&id={file_id}"
-
-            catalog_number = description = machine_type = manufacturer = analogs = detail_description = machine_model = "UNKNOWN"
+    YANDEX_FOLDER = os.getenv("YANDEX_FOLDER_ID")
 
-            try:
-                print(f"[INFO] Анализ {file_name} ...")
-                response = vision_client.Analyze(
-                    folder_id=os.getenv("YANDEX_FOLDER_ID"),
-                    analyze_specs=[{
-                        "content": requests.get(file_url).content,
-                        "features": [{"type": "TEXT_DETECTION"}]
-                    }]
-                )
-
-                texts = []
-                for result in response.results:
-                    for text_block in result.text_detection.pages[0].blocks:
-                        for line in text_block.lines:
-                            line_text = "".join([el.text for el in line.elements])
-                            texts.append(line_text)
-
-                full_text = " ".join(texts)
-
-                if "Catalog" in full_text:
-                    catalog_number = full_text.split("Catalog")[1].split()[0]
-                if "Description" in full_text:
-                    description = full_text.split("Description")[1].split("\n")[0]
+    # Скачивание, распознавание и запись идут параллельно на разных файлах;
+    # очередь скачанных ограничена, чтобы не держать в памяти лишние картинки
+    files_q = queue.Queue()
+    downloaded_q = queue.Queue(maxsize=2 * VISION_WORKERS)
+    analyzed_q = queue.Queue()
 
-            except Exception as e:
-                print(f"[ERROR] Ошибка анализа {file_name}: {e}")
-                traceback.print_exc()
+    downloaders = start_workers(DOWNLOAD_WORKERS, download_worker, session, files_q, downloaded_q, analyzed_q)
+    analyzers = start_workers(VISION_WORKERS, vision_worker, vision_client, YANDEX_FOLDER, downloaded_q, analyzed_q)
+    writers = start_workers(1, sheets_worker, job_id, drive, sheet, ANALYZED, analyzed_q)
 
-            try:
-                file_info = drive.files().get(fileId=file_id, fields="parents").execute()
-                prev_parents = ",".join(file_info.get("parents", []))
-                drive.files().update(
-                    fileId=file_id,
-                    addParents=ANALYZED,
-                    removeParents=prev_parents,
-                    fields="id, parents"
-                ).execute()
-            except Exception:
-                print(f"[ERROR] Не удалось переместить {file_name}")
-                traceback.print_exc()
+    # Файлы уходят в работу постранично, не дожидаясь конца листинга
+    listed = 0
+    list_error = None
+    try:
+        for f in list_files(drive, TO_ANALYZE):
+            files_q.put(f)
+            listed += 1
+    except Exception as e:
+        traceback.print_exc()
+        list_error = "Google Drive недоступен"
+        if isinstance(e, RefreshError):
+            reset_google_clients()
+            list_error = "Не удалось обновить токен сервисного аккаунта"
+    update_job(job_id, total=listed)
 
-            try:
-                sheet.append_row([catalog_number, description, machine_type, manufacturer, analogs, detail_description, machine_model, file_url])
-            except Exception:
-                print(f"[ERROR] Не удалось записать строку для {file_name}")
-                traceback.print_exc()
+    stop_workers(downloaders, files_q)
+    stop_workers(analyzers, downloaded_q)
+    stop_workers(writers, analyzed_q)
 
-            processed.append({
-                "file": file_name,
-                "catalog_number": catalog_number,
-                "description": description
-            })
+    if list_error:
+        update_job(job_id, status="error", message=list_error)
+        return
+    update_job(job_id, status="done")
 
-        time.sleep(1)
 
-    return jsonify({"status": "done", "processed_count": len(processed), "processed": processed})
+@app.route("/analyze", methods=["POST"])
+def analyze():
+    job_id = uuid.uuid4().hex
+    with jobs_lock:
+        jobs[job_id] = {"status": "queued", "message": "", "total": None, "processed": []}
+        finished = [jid for jid, job in jobs.items() if job["status"] in ("done", "error")]
+        for jid in finished[:max(0, len(jobs) - MAX_JOBS)]:
+            del jobs[jid]
+    JOB_EXECUTOR.submit(run_analysis, job_id)
+    print(f"[INFO] Задача {job_id} поставлена в очередь")
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+
+@app.route("/analyze/<job_id>", methods=["GET"])
+def analyze_status(job_id):
+    # ?since=N — отдать только результаты начиная с N-го, клиент передаёт последний next
+    since = request.args.get("since", 0, type=int)
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "Задача не найдена"}), 404
+        processed_count = len(job["processed"])
+        payload = {
+            "job_id": job_id,
+            "status": job["status"],
+            "message": job["message"],
+            "total": job["total"],
+            "processed_count": processed_count,
+            "processed": job["processed"][since:],
+            "next": processed_count,
+        }
+    return jsonify(payload)
 
 
 if __name__ == "__main__":
     check_requirements()
+    init_services()
     port = int(os.getenv("PORT", 5000))
-    print(f"[INFO] Запуск Flask на порту {port}...")
-    app.run(host="0.0.0.0", port=port, debug=True)
+    print(f"[INFO] Запуск Flask на порту {port} (для продакшена: gunicorn -c gunicorn.conf.py app:app)...")
+    app.run(host="0.0.0.0", port=port, threaded=True)
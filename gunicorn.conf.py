@@ -0,0 +1,17 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Один процесс: очередь задач и их статусы хранятся в памяти воркера.
+# Потоки обслуживают /ping и опрос статуса, пока идёт анализ.
+workers = 1
+worker_class = "gthread"
+threads = 8
+timeout = 120
+
+
+def post_worker_init(worker):
+    from app import check_requirements, init_services
+
+    check_requirements()
+    init_services()